@@ -2332,6 +2332,11 @@ class TensorDict(TensorDictBase):
             dest._is_memmap = True
             dest._is_shared = False  # since they are mutually exclusive
 
+        if prefix is None and executor is None:
+            batched = _populate_memmap_batch(self, like=like)
+        else:
+            batched = {}
+
         for key, value in self.items():
             type_value = type(value)
             if _is_tensor_collection(type_value):
@@ -2350,8 +2355,10 @@ class TensorDict(TensorDictBase):
                     )
                 continue
             else:
-
-                if executor is None:
+                memmap_tensor = batched.get(key)
+                if memmap_tensor is not None:
+                    dest._tensordict[key] = memmap_tensor
+                elif executor is None:
                     _populate_memmap(
                         dest=dest,
                         value=value,
@@ -4160,6 +4167,35 @@ def _populate_memmap(*, dest, value, key, copy_existing, prefix, like):
     return memmap_tensor
 
 
+# Largest leaf, in bytes, allocated together with its siblings by memmap().
+# Batching pays off for small leaves, where the per-file overhead dominates.
+# Batched leaves share one file that is only freed once all of them are gone,
+# so a large leaf would keep the memory of its siblings alive (and could push
+# the whole node out of /dev/shm).
+_MEMMAP_BATCH_MAX_BYTES = 1 << 20
+
+
+def _populate_memmap_batch(source, *, like):
+    # Small plain tensors that end up handler-backed are allocated together,
+    # with a single file and mapping for the node.
+    items = [
+        (key, value)
+        for key, value in source.items()
+        if type(value) is torch.Tensor
+        and not value.is_nested
+        and value.numel() * value.element_size() <= _MEMMAP_BATCH_MAX_BYTES
+    ]
+    if len(items) < 2:
+        return {}
+    memmap_tensors = MemoryMappedTensor.batch_empty_like([value for _, value in items])
+    result = {}
+    for (key, value), memmap_tensor in zip(items, memmap_tensors):
+        if not like:
+            memmap_tensor.copy_(value.data if value.requires_grad else value)
+        result[key] = memmap_tensor
+    return result
+
+
 def _populate_empty(
     *,
     dest,
@@ -3187,7 +3187,12 @@ class TensorDictBase(MutableMapping):
         if filename is not None:
             if use_buffer:
                 with open(filename, "w+b") as f:
-                    f.write(total_storage._handler.buffer)
+                    # the handler buffer may be larger than the storage
+                    f.write(
+                        memoryview(total_storage._handler.buffer)[
+                            : total_storage.numel()
+                        ]
+                    )
             # with open(Path(filename).with_suffix(".json"), "wb") as f:
             #     metadata_dict["size"] = filesize
             #     f.write(json.dumps(metadata_dict))
@@ -2,9 +2,26 @@
 #
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
+"""Memory-mapped tensors.
+
+Tensors created without a filename are backed by unlinked temporary files,
+placed in the first of these locations that has room for them:
+
+- the directory named by the ``TENSORDICT_SHM_DIR`` environment variable, if
+  it exists (e.g. to move these files off a small ``/dev/shm``);
+- for buffers of 256 MiB or more, the hugetlbfs mount named by
+  ``TENSORDICT_HUGEPAGE_DIR``, if set. Huge pages are reserved for the whole
+  buffer when it is created and come from a pool shared by the whole system,
+  so they are off by default;
+- ``/dev/shm`` (Linux only);
+- the default temporary directory.
+
+Both environment variables are read at import time.
+"""
 
 from __future__ import annotations
 
+import errno
 import functools
 
 import mmap
@@ -12,6 +29,8 @@ import os
 
 import sys
 import tempfile
+import time
+import weakref
 from multiprocessing import util
 from multiprocessing.context import reduction
 from pathlib import Path
@@ -140,11 +159,14 @@ class MemoryMappedTensor(torch.Tensor):
         copy_existing=False,
         copy_data=True,
         shape=None,
+        shared_file=False,
     ):
         """Creates a MemoryMappedTensor with the same content as another tensor.
 
         If the tensor is already a MemoryMappedTensor the original tensor is
         returned if the `filename` argument is `None` or if the two paths match.
+        Pass ``copy_existing=True`` to copy file-backed tensors when `filename`
+        is `None`.
         In all other cases, a new :class:`MemoryMappedTensor` is produced.
 
         Args:
@@ -159,15 +181,37 @@ class MemoryMappedTensor(torch.Tensor):
                 is a MemoryMappedTensor with an associated filename, copying
                 the content to the new location is permitted. Otherwise, an
                 exception is thrown. This behaviour exists to prevent
-                inadvertently duplicating data on disk.
+                inadvertently duplicating data on disk. If ``filename`` is
+                ``None``, file-backed inputs are copied to a handler rather
+                than returned as they are.
             copy_data (bool, optional): if ``True``, the content of the tensor
                 will be copied on the storage. Defaults to ``True``.
             shape (torch.Size or torch.Tensor): a shape to override the tensor
                 shape. If a tensor is passed, it must represent the nested shapes of a
                 nested tensor.
+            shared_file (bool, optional): if ``True``, a regular tensor that is a
+                contiguous view over a whole file mapping is assumed to be a
+                shared mapping (e.g., obtained through :func:`torch.from_file`
+                with ``shared=True``), whose content is the content of the file.
+                Such a tensor is then wrapped without any copy if the paths
+                match or if `filename` is `None`. Private mappings must not be
+                passed with this flag, as their changes never reach the file.
+                Defaults to ``False``.
         """
         if isinstance(input, MemoryMappedTensor):
-            if (filename is None and input._filename is None) or (
+            if (
+                filename is None
+                and (
+                    input._filename is None
+                    or (
+                        copy_data
+                        and not copy_existing
+                        # read-only files are mapped privately: the data may
+                        # differ from the file
+                        and _is_writable(input._filename)
+                    )
+                )
+            ) or (
                 input._filename is not None
                 and filename is not None
                 and Path(filename).absolute() == Path(input.filename).absolute()
@@ -193,47 +237,54 @@ class MemoryMappedTensor(torch.Tensor):
             raise RuntimeError(
                 "MemoryMappedTensor.from_tensor is incompatible with tensor.requires_grad."
             )
+        if shared_file and shape is None and not isinstance(input, MemoryMappedTensor):
+            input_filename = _file_backing(input)
+            if input_filename is not None and (
+                (filename is None and copy_data and not copy_existing)
+                or (
+                    filename is not None
+                    and Path(filename).absolute() == Path(input_filename).absolute()
+                )
+            ):
+                # the data is already in the file, wrap it as it is
+                result = cls(input)
+                result.filename = input_filename
+                result.index = None
+                result.parent_shape = input.shape
+                return result
         if shape is None:
             shape = _shape(input, nested_shape=True)
-        if isinstance(shape, torch.Tensor):
-            shape_numel = shape.prod(-1).sum()
-        elif isinstance(shape, torch.Size):
-            shape_numel = shape.numel()
+        if not isinstance(shape, torch.Tensor):
+            if (
+                copy_data
+                and filename is not None
+                and torch.Size(shape) == input.shape
+                and _copy_file_range(input, filename, shared_file)
+            ):
+                # the kernel copied the data, we only need to map the new file
+                return cls._empty(shape, input.dtype, filename, existsok=True)
+            result = cls._empty(shape, input.dtype, filename, existsok)
+            if copy_data:
+                if hasattr(input, "full_tensor"):
+                    # for DTensors, cheaper than importing DTensor every time
+                    input = input.full_tensor()
+                # copy_ is already split across the intra-op thread pool
+                # (see torch.set_num_threads), no need to chunk it here
+                result.copy_(input)
+            return result
+
+        # nested tensor
+        func_offset_stride = getattr(
+            torch, "_nested_compute_contiguous_strides_offsets", None
+        )
+        if func_offset_stride is not None:
+            offsets_strides = func_offset_stride(shape)
         else:
-            shape_numel = torch.Size(shape).numel()
+            raise RuntimeError(NESTED_TENSOR_ERR)
+        shape_numel = int(shape.prod(-1).sum())
         if filename is None:
-            if input.dtype.is_floating_point:
-                size = torch.finfo(input.dtype).bits // 8 * shape_numel
-            elif input.dtype.is_complex:
-                raise ValueError(
-                    "Complex-valued tensors are not supported by MemoryMappedTensor."
-                )
-            elif input.dtype == torch.bool:
-                size = shape_numel
-            else:
-                # assume integer
-                size = torch.iinfo(input.dtype).bits // 8 * shape_numel
-            handler = _FileHandler(size)
-            if isinstance(shape, torch.Tensor):
-                func_offset_stride = getattr(
-                    torch, "_nested_compute_contiguous_strides_offsets", None
-                )
-                if func_offset_stride is not None:
-                    offsets_strides = func_offset_stride(shape)
-                else:
-                    raise RuntimeError(NESTED_TENSOR_ERR)
-                result = torch.frombuffer(memoryview(handler.buffer), dtype=input.dtype)
-                if copy_data:
-                    result.untyped_storage().copy_(input.untyped_storage())
-                result = torch._nested_view_from_buffer(
-                    result,
-                    shape,
-                    *offsets_strides,
-                )
-            else:
-                result = torch.frombuffer(memoryview(handler.buffer), dtype=input.dtype)
-                result = result.view(shape)
-            result = cls(result)
+            handler = _FileHandler(_get_itemsize(input.dtype) * shape_numel)
+            result = _tensor_from_handler(handler, input.dtype, shape_numel)
         else:
             handler = None
             if not existsok and os.path.exists(str(filename)):
@@ -246,34 +297,47 @@ class MemoryMappedTensor(torch.Tensor):
                 # needed when device ctx differs
                 device=torch.device("cpu"),
             )
-            if isinstance(shape, torch.Tensor):
-                func_offset_stride = getattr(
-                    torch, "_nested_compute_contiguous_strides_offsets", None
-                )
-                if func_offset_stride is not None:
-                    offsets_strides = func_offset_stride(shape)
-                else:
-                    raise RuntimeError(NESTED_TENSOR_ERR)
-                if copy_data:
-                    result.untyped_storage().copy_(input.untyped_storage())
-                result = torch._nested_view_from_buffer(
-                    result,
-                    shape,
-                    *offsets_strides,
-                )
-            else:
-                result = result.view(shape)
-            result = cls(result)
+        if copy_data:
+            result.untyped_storage().copy_(input.untyped_storage())
+        result = torch._nested_view_from_buffer(
+            result,
+            shape,
+            *offsets_strides,
+        )
+        result = cls(result)
+        result._handler = handler
+        result.filename = filename
+        result.index = None
+        result.parent_shape = shape
+        return result
+
+    @classmethod
+    def _empty(cls, shape, dtype, filename=None, existsok=False):
+        # Allocates a (non-nested) tensor with no content. This is the common
+        # path of from_tensor and the factory methods: there is no example
+        # tensor to build or inspect.
+        shape = torch.Size(shape)
+        numel = shape.numel()
+        if filename is None:
+            handler = _FileHandler(_get_itemsize(dtype) * numel)
+            result = _tensor_from_handler(handler, dtype, numel)
+        else:
+            handler = None
+            if not existsok and os.path.exists(str(filename)):
+                raise RuntimeError(f"The file {filename} already exists.")
+            result = torch.from_file(
+                str(filename),
+                shared=True,
+                dtype=dtype,
+                size=numel,
+                # needed when device ctx differs
+                device=torch.device("cpu"),
+            )
+        result = cls(result.view(shape))
         result._handler = handler
         result.filename = filename
         result.index = None
         result.parent_shape = shape
-        if copy_data:
-            if hasattr(input, "full_tensor"):
-                # for DTensors, cheaper than importing DTensor every time
-                input = input.full_tensor()
-            if not result.is_nested:
-                result.copy_(input)
         return result
 
     @classmethod
@@ -361,11 +425,57 @@ class MemoryMappedTensor(torch.Tensor):
             filename (path or equivalent): the path to the file, if any. If none
                 is provided, a handler is used.
         """
-        return cls.from_tensor(
-            torch.zeros((), dtype=input.dtype, device=input.device).expand_as(input),
-            filename=filename,
-            copy_data=False,
+        return cls._empty(input.shape, input.dtype, filename)
+
+    @classmethod
+    def batch_empty_like(cls, inputs):
+        # noqa: D417
+        """Creates one handler-backed tensor with no content per input tensor, with the same shape and dtype.
+
+        All the tensors are carved out of a single file handler, such that a
+        single file is created and mapped regardless of the number of inputs.
+        The tensors can still be sent individually to other processes, but
+        the file is only released once none of them is referenced anymore.
+
+        Args:
+            inputs (list of torch.Tensor): the tensors to use as examples.
+                Nested tensors are not supported.
+
+        Examples:
+            >>> a, b = MemoryMappedTensor.batch_empty_like(
+            ...     [torch.zeros(3), torch.zeros(2, 2, dtype=torch.int64)]
+            ... )
+            >>> assert a.shape == (3,) and b.dtype == torch.int64
+        """
+        for input in inputs:
+            if input.is_nested:
+                raise RuntimeError(
+                    "MemoryMappedTensor.batch_empty_like does not support nested tensors."
+                )
+        count = len(inputs)
+        if not count:
+            return []
+        numels = np.fromiter((input.numel() for input in inputs), np.int64, count)
+        itemsizes = np.fromiter(
+            (_get_itemsize(input.dtype) for input in inputs), np.int64, count
         )
+        nbytes = numels * itemsizes
+        # keep every tensor on its own cache line
+        padded = -(-np.maximum(nbytes, 1) // _BATCH_ALIGNMENT) * _BATCH_ALIGNMENT
+        offsets = np.cumsum(padded) - padded
+        total_size = int(padded.sum())
+        handler = _FileHandler(total_size)
+        storage = _tensor_from_handler(handler, torch.uint8, total_size)
+        results = []
+        for input, offset, size in zip(inputs, offsets.tolist(), nbytes.tolist()):
+            shape = input.shape
+            result = cls(storage[offset : offset + size].view(input.dtype).view(shape))
+            result._handler = _FileHandlerRegion(handler, offset)
+            result.filename = None
+            result.index = None
+            result.parent_shape = shape
+            results.append(result)
+        return results
 
     @classmethod
     def full_like(cls, input, fill_value, *, filename=None):
@@ -380,11 +490,7 @@ class MemoryMappedTensor(torch.Tensor):
             filename (path or equivalent): the path to the file, if any. If none
                 is provided, a handler is used.
         """
-        return cls.from_tensor(
-            torch.zeros((), dtype=input.dtype, device=input.device).expand_as(input),
-            filename=filename,
-            copy_data=False,
-        ).fill_(fill_value)
+        return cls._empty(input.shape, input.dtype, filename).fill_(fill_value)
 
     @classmethod
     def zeros_like(cls, input, *, filename=None):
@@ -398,11 +504,10 @@ class MemoryMappedTensor(torch.Tensor):
             filename (path or equivalent): the path to the file, if any. If none
                 is provided, a handler is used.
         """
-        return cls.from_tensor(
-            torch.zeros((), dtype=input.dtype, device=input.device).expand_as(input),
-            filename=filename,
-            copy_data=False,
-        ).fill_(0.0)
+        result = cls._empty(input.shape, input.dtype, filename)
+        if not _is_zero_initialized(result):
+            result.fill_(0.0)
+        return result
 
     @classmethod
     def ones_like(cls, input, *, filename=None):
@@ -416,11 +521,7 @@ class MemoryMappedTensor(torch.Tensor):
             filename (path or equivalent): the path to the file, if any. If none
                 is provided, a handler is used.
         """
-        return cls.from_tensor(
-            torch.ones((), dtype=input.dtype, device=input.device).expand_as(input),
-            filename=filename,
-            copy_data=False,
-        ).fill_(1.0)
+        return cls._empty(input.shape, input.dtype, filename).fill_(1.0)
 
     @classmethod
     @overload
@@ -454,7 +555,6 @@ class MemoryMappedTensor(torch.Tensor):
             device = torch.device(device)
             if device.type != "cpu":
                 raise RuntimeError("Only CPU tensors are supported.")
-        result = torch.ones((), dtype=dtype, device=device)
         if isinstance(shape, torch.Tensor):
             return cls.empty(
                 shape, device=device, dtype=dtype, filename=filename
@@ -464,12 +564,10 @@ class MemoryMappedTensor(torch.Tensor):
                 shape = torch.Size(shape[0])
             else:
                 shape = torch.Size(shape)
-            result = result.expand(shape)
-        return cls.from_tensor(
-            result,
-            filename=filename,
-            existsok=kwargs.pop("existsok", False),
-        )
+        if dtype is None:
+            dtype = torch.get_default_dtype()
+        existsok = kwargs.pop("existsok", False)
+        return cls._empty(shape, dtype, filename, existsok).fill_(1)
 
     @classmethod
     @overload
@@ -504,21 +602,20 @@ class MemoryMappedTensor(torch.Tensor):
             if device.type != "cpu":
                 raise RuntimeError("Only CPU tensors are supported.")
         if isinstance(shape, torch.Tensor):
-            return cls.empty(
-                shape, device=device, dtype=dtype, filename=filename
-            ).fill_(0)
-        result = torch.zeros((), dtype=dtype, device=device)
+            result = cls.empty(shape, device=device, dtype=dtype, filename=filename)
+            if not _is_zero_initialized(result):
+                result.fill_(0)
+            return result
         if shape:
             if isinstance(shape[0], (list, tuple)) and len(shape) == 1:
                 shape = torch.Size(shape[0])
             else:
                 shape = torch.Size(shape)
-            result = result.expand(shape)
-        result = cls.from_tensor(
-            result,
-            filename=filename,
-            existsok=kwargs.pop("existsok", False),
-        )
+        if dtype is None:
+            dtype = torch.get_default_dtype()
+        result = cls._empty(shape, dtype, filename, kwargs.pop("existsok", False))
+        if not _is_zero_initialized(result):
+            result.fill_(0)
         return result
 
     @classmethod
@@ -553,23 +650,14 @@ class MemoryMappedTensor(torch.Tensor):
             device = torch.device(device)
             if device.type != "cpu":
                 raise RuntimeError("Only CPU tensors are supported.")
-        result = torch.zeros((), dtype=dtype, device=device)
+        if dtype is None:
+            dtype = torch.get_default_dtype()
         if isinstance(shape, torch.Tensor):
             # nested tensor
-            shape_numel = shape.prod(-1).sum()
+            shape_numel = int(shape.prod(-1).sum())
 
             if filename is None:
-                if dtype.is_floating_point:
-                    size = torch.finfo(dtype).bits // 8 * shape_numel
-                elif dtype.is_complex:
-                    raise ValueError(
-                        "Complex-valued tensors are not supported by MemoryMappedTensor."
-                    )
-                elif dtype == torch.bool:
-                    size = shape_numel
-                else:
-                    # assume integer
-                    size = torch.iinfo(dtype).bits // 8 * shape_numel
+                size = _get_itemsize(dtype) * shape_numel
                 handler = _FileHandler(size)
 
                 # buffer
@@ -580,7 +668,7 @@ class MemoryMappedTensor(torch.Tensor):
                     offsets_strides = func_offset_stride(shape)
                 else:
                     raise RuntimeError(NESTED_TENSOR_ERR)
-                result = torch.frombuffer(memoryview(handler.buffer), dtype=dtype)
+                result = _tensor_from_handler(handler, dtype, shape_numel)
                 result = torch._nested_view_from_buffer(
                     result,
                     shape,
@@ -620,14 +708,7 @@ class MemoryMappedTensor(torch.Tensor):
                 shape = torch.Size(shape[0])
             else:
                 shape = torch.Size(shape)
-            result = result.expand(shape)
-        result = cls.from_tensor(
-            result,
-            filename=filename,
-            copy_data=False,
-            existsok=kwargs.pop("existsok", False),
-        )
-        return result
+        return cls._empty(shape, dtype, filename, kwargs.pop("existsok", False))
 
     @classmethod
     def empty_nested(cls, *args, **kwargs):
@@ -701,16 +782,15 @@ class MemoryMappedTensor(torch.Tensor):
             device = torch.device(device)
             if device.type != "cpu":
                 raise RuntimeError("Only CPU tensors are supported.")
-        result = torch.zeros((), dtype=dtype, device=device).fill_(fill_value)
         if shape:
             if isinstance(shape[0], (list, tuple)) and len(shape) == 1:
                 shape = torch.Size(shape[0])
             else:
                 shape = torch.Size(shape)
-            result = result.expand(shape)
-        return cls.from_tensor(
-            result, filename=filename, existsok=kwargs.pop("existsok", False)
-        )
+        if dtype is None:
+            dtype = torch.get_default_dtype()
+        existsok = kwargs.pop("existsok", False)
+        return cls._empty(shape, dtype, filename, existsok).fill_(fill_value)
 
     @classmethod
     def from_filename(cls, filename, dtype, shape, index=None):
@@ -791,8 +871,8 @@ class MemoryMappedTensor(torch.Tensor):
                 tensor.
 
         """
-        out = torch.frombuffer(memoryview(handler.buffer), dtype=dtype)
         if isinstance(shape, torch.Tensor):
+            out = _tensor_from_handler(handler, dtype, int(shape.prod(-1).sum()))
             func_offset_stride = getattr(
                 torch, "_nested_compute_contiguous_strides_offsets", None
             )
@@ -811,7 +891,8 @@ class MemoryMappedTensor(torch.Tensor):
             )
         else:
             shape = torch.Size(shape)
-            out = torch.reshape(out, shape)
+            # the flat tensor has exactly numel elements, a view is enough
+            out = _tensor_from_handler(handler, dtype, shape.numel()).view(shape)
 
         if index is not None:
             out = out[index]
@@ -952,6 +1033,8 @@ if sys.platform == "win32":
             self.name = name
             self.buffer = buf
             self._state = (self.size, self.name)
+            # anonymous mappings are zero-filled by the OS
+            self._is_zero_initialized = True
 
         def __getstate__(self):
             from multiprocessing.context import assert_spawning
@@ -961,6 +1044,7 @@ if sys.platform == "win32":
 
         def __setstate__(self, state):
             self.size, self.name = self._state = state
+            self._is_zero_initialized = False
             # Reopen existing mmap
             self.buffer = mmap.mmap(-1, self.size, tagname=self.name)
             # XXX Temporarily preventing buildbot failures while determining
@@ -968,32 +1052,175 @@ if sys.platform == "win32":
             # assert _winapi.GetLastError() == _winapi.ERROR_ALREADY_EXISTS
 
 else:
+    _HAS_O_TMPFILE = hasattr(os, "O_TMPFILE")
+    _HAS_FALLOCATE = hasattr(os, "posix_fallocate")
+    # smallest buffer worth rounding up to whole huge pages
+    _HUGEPAGE_MIN_SIZE = 256 * 1024 * 1024
+    # The free space probe is reused for small buffers only, and for a short
+    # while: other processes fill the same directories, and a sparse file
+    # that outgrows its filesystem fails with a SIGBUS when written, not when
+    # it is created.
+    _DIR_CACHE_MAX_SIZE = 1024 * 1024
+    _DIR_CACHE_TTL = 1.0
 
     class _FileHandler:
-        if sys.platform == "linux":
-            _dir_candidates = ["/dev/shm"]
-        else:
-            _dir_candidates = []
+        # directory set by the user, if any
+        _shm_dir = os.environ.get("TENSORDICT_SHM_DIR") or None
+        if _shm_dir is not None and not os.path.isdir(_shm_dir):
+            _shm_dir = None
+        # directories tried in order before the default temporary directory
+        _dir_candidates = [
+            dirname
+            for dirname in (_shm_dir, "/dev/shm" if sys.platform == "linux" else None)
+            if dirname and os.path.isdir(dirname)
+        ]
+        # hugetlbfs mount for large buffers, only used if the user asks for it:
+        # huge pages are committed upfront, from a pool reserved system-wide
+        _hugepage_dir = os.environ.get("TENSORDICT_HUGEPAGE_DIR") or None
+
+        # directories whose filesystem rejected O_TMPFILE
+        _no_tmpfile_dirs = set()
+        # directory picked by the last free space probe, the space left there
+        # after the allocations made since then, and the time of the probe
+        _cached_dir = None
+        _cached_dir_free = 0
+        _cached_dir_time = 0.0
 
         def __init__(self, size, fd=-1):
             self.size = size
             self.fd = fd
+            # a new file reads as zeros, a file received from another process
+            # may already hold data
+            self._is_zero_initialized = fd == -1
             if fd == -1:
-                self.fd, name = tempfile.mkstemp(
-                    prefix="pym-%d-" % os.getpid(), dir=self._choose_dir(size)
-                )
-                os.unlink(name)
-                util.Finalize(self, os.close, (self.fd,))
-                os.ftruncate(self.fd, size)
-            self.buffer = mmap.mmap(self.fd, self.size)
+                if (
+                    self._hugepage_dir is not None
+                    and size >= _HUGEPAGE_MIN_SIZE
+                    and not self._fits_shm_dir(size)
+                ):
+                    self.fd, self.size = self._create_hugepages(size)
+                if self.fd == -1:
+                    self.fd = self._create_file(size)
+                # The mmap is left to be closed by its own finalizer: tensors
+                # built with frombuffer may still export it.
+                weakref.finalize(self, os.close, self.fd)
+
+        def __reduce__(self):
+            # Only picklable when sent to another process (where the reducer
+            # registered below is used): the fd number alone is meaningless
+            # anywhere else, e.g. in a deepcopy or a saved file.
+            from multiprocessing.context import assert_spawning
+
+            assert_spawning(self)
+            return _reduce_handler(self)
+
+        @functools.cached_property
+        def buffer(self):
+            # Mapped on first access. Tensors built on the handler read the
+            # buffer right away, except empty ones: mmap refuses to map an
+            # empty file, so handlers of empty tensors must never map it.
+            return mmap.mmap(self.fd, self.size)
+
+        def _fits_shm_dir(self, size):
+            # a directory set by the user is preferred to huge pages
+            if self._shm_dir is None:
+                return False
+            st = os.statvfs(self._shm_dir)
+            return st.f_bavail * st.f_frsize >= size
+
+        def _create_hugepages(self, size):
+            # Large buffers are backed by huge pages when a hugetlbfs mount has
+            # room for them, which cuts TLB misses when sweeping through them.
+            # Files there are sized in whole pages, so the size is rounded up.
+            # Returns (-1, size) if huge pages cannot be used.
+            dirname = self._hugepage_dir
+            if not _HAS_FALLOCATE or not os.access(dirname, os.W_OK):
+                return -1, size
+            try:
+                st = os.statvfs(dirname)
+                page_size = st.f_bsize
+                size = -(-size // page_size) * page_size
+                # Mounts without a size limit report no blocks at all; the
+                # pool of free pages only shows when fallocate fails below.
+                if st.f_blocks and st.f_bavail * page_size < size:
+                    return -1, size
+                fd = self._open_unnamed(dirname)
+            except OSError:
+                return -1, size
+            try:
+                # Pages must be reserved now: running out of huge pages when
+                # the tensor is first written would raise a SIGBUS.
+                os.posix_fallocate(fd, 0, size)
+            except OSError:
+                os.close(fd)
+                return -1, size
+            return fd, size
+
+        def _create_file(self, size):
+            # If the file cannot be created in the chosen directory (read-only
+            # mount, exhausted inodes or quota...), the next candidates and
+            # then the temporary directory are tried as they are, without
+            # probing their free space again. A full tmpfs is not caught
+            # here: sparse files are created regardless of the space left.
+            dirname = self._choose_dir(size)
+            if dirname not in self._dir_candidates:
+                return self._create(dirname, size)
+            index = self._dir_candidates.index(dirname)
+            for fallback in self._dir_candidates[index + 1 :] + [util.get_temp_dir()]:
+                try:
+                    return self._create(dirname, size)
+                except OSError:
+                    _FileHandler._cached_dir = None
+                    dirname = fallback
+            return self._create(dirname, size)
+
+        def _create(self, dirname, size):
+            fd = self._open_unnamed(dirname)
+            try:
+                # A sparse file: pages only take memory once they are
+                # written, and read as zeros until then.
+                os.ftruncate(fd, size)
+            except BaseException:
+                os.close(fd)
+                raise
+            return fd
+
+        def _open_unnamed(self, dirname):
+            # O_TMPFILE creates an unlinked file in a single syscall, which
+            # saves the mkstemp / unlink round-trip on every allocation.
+            if _HAS_O_TMPFILE and dirname not in self._no_tmpfile_dirs:
+                try:
+                    return os.open(dirname, os.O_TMPFILE | os.O_RDWR, 0o600)
+                except OSError as err:
+                    if err.errno not in (errno.EISDIR, errno.EOPNOTSUPP, errno.EINVAL):
+                        raise
+                    self._no_tmpfile_dirs.add(dirname)
+            fd, name = tempfile.mkstemp(prefix="pym-%d-" % os.getpid(), dir=dirname)
+            os.unlink(name)
+            return fd
 
         def _choose_dir(self, size):
             # Choose a non-storage backed directory if possible,
-            # to improve performance
+            # to improve performance. Bursts of small allocations reuse the
+            # last free space probe as long as it guarantees enough room.
+            now = time.monotonic()
+            if (
+                _FileHandler._cached_dir is not None
+                and size <= _DIR_CACHE_MAX_SIZE
+                and size <= _FileHandler._cached_dir_free
+                and now - _FileHandler._cached_dir_time < _DIR_CACHE_TTL
+            ):
+                _FileHandler._cached_dir_free -= size
+                return _FileHandler._cached_dir
             for d in self._dir_candidates:
                 st = os.statvfs(d)
-                if st.f_bavail * st.f_frsize >= size:  # enough free space?
+                free = st.f_bavail * st.f_frsize
+                if free >= size:  # enough free space?
+                    _FileHandler._cached_dir = d
+                    _FileHandler._cached_dir_free = free - size
+                    _FileHandler._cached_dir_time = now
                     return d
+            _FileHandler._cached_dir = None
             return util.get_temp_dir()
 
     def _reduce_handler(handler):
@@ -1011,6 +1238,155 @@ else:
     reduction.register(_FileHandler, _reduce_handler)
 
 
+def _tensor_from_handler(handler, dtype, numel):
+    """Builds a flat tensor of ``numel`` elements on top of a file handler."""
+    # The caller keeps the handler alive as ``_handler`` on the MemoryMappedTensor
+    # (and every indexed view of it), and frombuffer holds the mmap.
+    # The storage must not be a torch.from_file mapping: plain views of the
+    # tensor (e.g. ``mt.view(-1)``) are shared through torch.multiprocessing,
+    # which cannot share a file mapping that did not keep its descriptor.
+    if not numel:
+        # frombuffer refuses empty reads
+        return torch.empty((0,), dtype=dtype)
+    # The handler file can be larger than the tensor (huge pages come in
+    # whole pages only, regions are slices of a larger buffer): the buffer
+    # maps all of it, the tensor what it needs.
+    return torch.frombuffer(
+        handler.buffer,
+        dtype=dtype,
+        count=numel,
+        offset=getattr(handler, "offset", 0),
+    )
+
+
+def _is_zero_initialized(memmap_tensor):
+    # Freshly allocated handler files are zero-filled, so filling them with
+    # zeros again is a wasted pass over the whole buffer.
+    handler = memmap_tensor._handler
+    return handler is not None and handler._is_zero_initialized
+
+
+class _FileHandlerRegion:
+    """A slice of a file handler, starting ``offset`` bytes into its buffer.
+
+    Tensors created together by :meth:`MemoryMappedTensor.batch_empty_like`
+    share one handler; each of them keeps a region pointing to its own data.
+    Regions are pickled along with the handler they point to.
+    """
+
+    def __init__(self, handler, offset):
+        self.handler = handler
+        self.offset = offset
+
+    @property
+    def buffer(self):
+        return self.handler.buffer
+
+    @property
+    def _is_zero_initialized(self):
+        return self.handler._is_zero_initialized
+
+
+# alignment of the tensors within a batched allocation, in bytes
+_BATCH_ALIGNMENT = 64
+
+# bytes per element, filled as dtypes are met
+_DTYPE_ITEMSIZE = {}
+
+
+def _get_itemsize(dtype):
+    itemsize = _DTYPE_ITEMSIZE.get(dtype)
+    if itemsize is None:
+        if dtype.is_complex:
+            raise ValueError(
+                "Complex-valued tensors are not supported by MemoryMappedTensor."
+            )
+        itemsize = getattr(dtype, "itemsize", None)
+        if itemsize is None:
+            # older PyTorch versions
+            itemsize = torch.empty((), dtype=dtype).element_size()
+        _DTYPE_ITEMSIZE[dtype] = itemsize
+    return itemsize
+
+
+def _file_backing(tensor):
+    # The file a plain tensor maps as a whole, if any. Whether the mapping is
+    # shared with the file cannot be told from the storage.
+    if type(tensor) is not torch.Tensor or tensor.is_nested:
+        return None
+    if tensor.storage_offset() or not tensor.is_contiguous():
+        return None
+    storage = tensor.untyped_storage()
+    if storage.nbytes() != tensor.numel() * tensor.element_size():
+        return None
+    return getattr(storage, "filename", None)
+
+
+_HAS_COPY_FILE_RANGE = hasattr(os, "copy_file_range")
+# copy_file_range is not supported by the kernel or across these filesystems
+_COPY_FILE_RANGE_ERRNOS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP)
+
+
+def _copy_file_range(tensor, filename, shared_file):
+    """Copies the file behind a file-backed tensor to a new file ``filename`` within the kernel.
+
+    Only tensors known to map their file shared are copied this way, as the
+    file of a private mapping may not hold the tensor's data. Returns ``False``
+    when the data must be copied through ``copy_()`` instead, in which case
+    ``filename`` is left as it was found.
+    """
+    if not _HAS_COPY_FILE_RANGE or tensor.is_nested:
+        return False
+    if tensor.storage_offset() or not tensor.is_contiguous():
+        return False
+    if isinstance(tensor, MemoryMappedTensor):
+        # from_filename maps read-only files privately
+        src = tensor._filename
+        if src is None or not _is_writable(src):
+            return False
+    elif shared_file:
+        src = getattr(tensor.untyped_storage(), "filename", None)
+        if src is None:
+            return False
+    else:
+        return False
+    filename = str(filename)
+    # existing files are overwritten through copy_()
+    if os.path.exists(filename) or Path(src).absolute() == Path(filename).absolute():
+        return False
+    nbytes = tensor.numel() * tensor.element_size()
+    if not nbytes:
+        return False
+    copied = 0
+    try:
+        src_fd = os.open(src, os.O_RDONLY)
+        try:
+            # same mode as the files created by torch.from_file
+            dst_fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            try:
+                while copied < nbytes:
+                    count = os.copy_file_range(src_fd, dst_fd, nbytes - copied)
+                    if not count:
+                        # the source file is shorter than the tensor
+                        break
+                    copied += count
+            except BaseException:
+                os.unlink(filename)
+                raise
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+    except OSError as err:
+        if err.errno not in _COPY_FILE_RANGE_ERRNOS:
+            raise
+        return False
+    if copied == nbytes:
+        return True
+    os.unlink(filename)
+    return False
+
+
 def _reduce_memmap(memmap_tensor):
     return memmap_tensor.__reduce__()
 
@@ -3,10 +3,15 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 import argparse
+import copy
+import errno
 import gc
 import os
+import pickle
 import stat
+import sys
 from contextlib import nullcontext
+from multiprocessing import util
 from pathlib import Path
 
 import pytest
@@ -14,7 +19,7 @@ import torch
 from _utils_internal import get_available_devices
 from tensordict import TensorDict
 
-from tensordict.memmap import _is_writable, MemoryMappedTensor
+from tensordict.memmap import _FileHandler, _is_writable, MemoryMappedTensor
 from torch import multiprocessing as mp
 
 TIMEOUT = 100
@@ -438,6 +443,56 @@ class TestIndexing:
         finally:
             p.join()
 
+    @staticmethod
+    def _recv_plain_view(queue_out, queue_in):
+        t = queue_in.get(timeout=TIMEOUT)
+        assert type(t) is torch.Tensor
+        assert (t == 1).all()
+        queue_out.put("done")
+
+    def test_send_plain_view_across_procs(self):
+        # views that lost the MemoryMappedTensor type are shared through
+        # torch.multiprocessing like any other CPU tensor
+        t = MemoryMappedTensor.from_tensor(torch.ones(3, 4))
+        view = t.view(-1).as_subclass(torch.Tensor)
+        queue_in = mp.Queue(1)
+        queue_out = mp.Queue(1)
+        p = mp.Process(target=TestIndexing._recv_plain_view, args=(queue_in, queue_out))
+        p.start()
+        try:
+            queue_out.put(view, block=True)
+            msg = queue_in.get(timeout=TIMEOUT)
+            assert msg == "done"
+        finally:
+            p.join()
+
+    @staticmethod
+    def _send_rebuilt_plain_view(queue_out, queue_in):
+        t = queue_in.get(timeout=TIMEOUT)
+        assert isinstance(t, MemoryMappedTensor)
+        queue_out.put(t.view(-1).as_subclass(torch.Tensor))
+        msg = queue_in.get(timeout=TIMEOUT)
+        assert msg == "done"
+
+    def test_send_rebuilt_plain_view_across_procs(self):
+        # a tensor rebuilt from its handler in another process can be shared
+        # back through a plain view
+        t = MemoryMappedTensor.from_tensor(torch.ones(3, 4))
+        queue_in = mp.Queue(1)
+        queue_out = mp.Queue(1)
+        p = mp.Process(
+            target=TestIndexing._send_rebuilt_plain_view, args=(queue_in, queue_out)
+        )
+        p.start()
+        try:
+            queue_out.put(t, block=True)
+            view = queue_in.get(timeout=TIMEOUT)
+            assert type(view) is torch.Tensor
+            assert (view == 1).all()
+            queue_out.put("done", block=True)
+        finally:
+            p.join()
+
     def test_iteration(self):
         t = MemoryMappedTensor.from_tensor(torch.rand(10))
         for i, _t in enumerate(t):
@@ -545,6 +600,100 @@ def test_memmap_from_memmap():
     assert mt2.squeeze(-1).shape == torch.Size([4, 3, 2])
 
 
+def test_from_tensor_file_backed(tmp_path):
+    filename = tmp_path / "test.memmap"
+    tensor = torch.from_file(
+        str(filename), shared=True, dtype=torch.float32, size=6
+    ).view(2, 3)
+    tensor.fill_(1)
+    # the tensor already lives in a file: no copy is made
+    mt = MemoryMappedTensor.from_tensor(tensor, filename=filename, shared_file=True)
+    assert mt.data_ptr() == tensor.data_ptr()
+    assert mt.filename == str(filename.absolute())
+    mt = MemoryMappedTensor.from_tensor(tensor, shared_file=True)
+    assert mt.data_ptr() == tensor.data_ptr()
+    assert mt.filename == str(filename.absolute())
+    mt = MemoryMappedTensor.from_tensor(tensor, shared_file=True, copy_existing=True)
+    assert mt.data_ptr() != tensor.data_ptr()
+    assert (mt == 1).all()
+    # without the flag, the data is copied
+    mt = MemoryMappedTensor.from_tensor(tensor)
+    assert mt.data_ptr() != tensor.data_ptr()
+    assert mt._filename is None
+    # a view over part of the mapping is copied
+    mt = MemoryMappedTensor.from_tensor(tensor[:1], shared_file=True)
+    assert mt.data_ptr() != tensor.data_ptr()
+    assert mt._filename is None
+
+
+def test_from_tensor_private_mapping(tmp_path):
+    filename = tmp_path / "test.memmap"
+    MemoryMappedTensor.from_tensor(torch.ones(2, 3), filename=filename)
+    tensor = torch.from_file(
+        str(filename), shared=False, dtype=torch.float32, size=6
+    ).view(2, 3)
+    # changes to a private mapping never reach the file
+    tensor.fill_(2)
+    mt = MemoryMappedTensor.from_tensor(tensor)
+    assert mt.data_ptr() != tensor.data_ptr()
+    assert (mt == 2).all()
+    mt = MemoryMappedTensor.from_tensor(tensor, filename=tmp_path / "other.memmap")
+    assert (mt == 2).all()
+    mt = MemoryMappedTensor.from_tensor(tensor, filename=filename, existsok=True)
+    assert (mt == 2).all()
+    reloaded = MemoryMappedTensor.from_filename(
+        filename, dtype=torch.float32, shape=(2, 3)
+    )
+    assert (reloaded == 2).all()
+
+
+def test_from_tensor_copy_file(tmp_path):
+    mt = MemoryMappedTensor.from_tensor(
+        torch.arange(12).view(3, 4), filename=tmp_path / "src.memmap"
+    )
+    copied = MemoryMappedTensor.from_tensor(
+        mt, filename=tmp_path / "dest.memmap", copy_existing=True
+    )
+    assert copied.filename == str((tmp_path / "dest.memmap").absolute())
+    assert copied.shape == mt.shape
+    assert (copied == torch.arange(12).view(3, 4)).all()
+    # the copy does not share its content with the source
+    copied.zero_()
+    assert (mt == torch.arange(12).view(3, 4)).all()
+    # the new file gets the same permissions as any other memmap file
+    assert stat.S_IMODE(os.stat(copied.filename).st_mode) == stat.S_IMODE(
+        os.stat(mt.filename).st_mode
+    )
+    with pytest.raises(RuntimeError, match="already exists"):
+        MemoryMappedTensor.from_tensor(
+            mt, filename=tmp_path / "dest.memmap", copy_existing=True
+        )
+    # an existing file is overwritten with the tensor's data
+    copied = MemoryMappedTensor.from_tensor(
+        mt, filename=tmp_path / "dest.memmap", copy_existing=True, existsok=True
+    )
+    assert (copied == torch.arange(12).view(3, 4)).all()
+
+
+@pytest.mark.parametrize(
+    "dtype_name",
+    ["float8_e4m3fnuz", "float8_e5m2fnuz", "float8_e8m0fnu", "float64", "uint8"],
+)
+def test_memmap_itemsize(dtype_name):
+    dtype = getattr(torch, dtype_name, None)
+    if dtype is None:
+        pytest.skip(f"torch.{dtype_name} is not available")
+    mt = MemoryMappedTensor.empty((3, 2), dtype=dtype)
+    assert mt.dtype == dtype
+    assert mt.shape == (3, 2)
+    assert mt.element_size() == torch.empty((), dtype=dtype).element_size()
+
+
+def test_memmap_complex():
+    with pytest.raises(ValueError, match="Complex-valued"):
+        MemoryMappedTensor.empty((3,), dtype=torch.complex64)
+
+
 def test_memmap_cast():
     # ensure memmap can be cast to tensor and viceversa
     x = torch.zeros(3, 4, 5)
@@ -556,6 +705,219 @@ def test_memmap_cast():
     assert (y[2:] == 0).all()
 
 
+def test_batch_empty_like():
+    inputs = [
+        torch.zeros(3, 4),
+        torch.zeros((), dtype=torch.int64),
+        torch.zeros(0, 2, dtype=torch.bool),
+        torch.zeros(5, dtype=torch.half),
+    ]
+    outputs = MemoryMappedTensor.batch_empty_like(inputs)
+    assert len(outputs) == len(inputs)
+    handler = outputs[0]._handler.handler
+    for input, output in zip(inputs, outputs):
+        assert isinstance(output, MemoryMappedTensor)
+        assert output.shape == input.shape
+        assert output.dtype == input.dtype
+        assert output._handler.handler is handler
+    for i, output in enumerate(outputs):
+        output.fill_(i)
+    for i, output in enumerate(outputs):
+        assert (output == i).all()
+        # a tensor rebuilt from its handler region sees the same data
+        func, args = output.__reduce__()
+        rebuilt = func(*args)
+        assert rebuilt.shape == output.shape
+        assert (rebuilt == i).all()
+        rebuilt.zero_()
+        assert (output == 0).all()
+    assert MemoryMappedTensor.batch_empty_like([]) == []
+
+
+def test_memmap_td_batched():
+    td = TensorDict(
+        {"a": torch.randn(3), "b": torch.arange(4), "c": {"d": torch.ones(2)}}, []
+    )
+    tdmemmap = td.memmap()
+    assert list(tdmemmap.keys()) == list(td.keys())
+    assert tdmemmap["a"]._handler.handler is tdmemmap["b"]._handler.handler
+    assert (tdmemmap == td).all()
+    # large leaves get a file of their own
+    td["e"] = torch.zeros(2**20)
+    tdmemmap = td.memmap()
+    assert tdmemmap["a"]._handler.handler is tdmemmap["b"]._handler.handler
+    assert tdmemmap["e"]._handler is not tdmemmap["a"]._handler.handler
+    assert not hasattr(tdmemmap["e"]._handler, "offset")
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="POSIX file handlers only")
+def test_zeros_not_zero_initialized(tmp_path, monkeypatch):
+    import tensordict.memmap
+
+    ones = MemoryMappedTensor.from_tensor(torch.ones(3))
+    assert ones._handler._is_zero_initialized
+    # a handler rebuilt from a received fd may already hold data
+    monkeypatch.setattr(
+        tensordict.memmap,
+        "_FileHandler",
+        lambda size: _FileHandler(size, os.dup(ones._handler.fd)),
+    )
+    zeros = MemoryMappedTensor.zeros(3)
+    assert not zeros._handler._is_zero_initialized
+    assert (zeros == 0).all()
+    ones.fill_(1)
+    assert (MemoryMappedTensor.zeros_like(ones) == 0).all()
+    monkeypatch.undo()
+
+    # so may a reused file
+    filename = tmp_path / "test.memmap"
+    MemoryMappedTensor.from_tensor(torch.ones(3), filename=filename)
+    zeros = MemoryMappedTensor.zeros(3, filename=filename, existsok=True)
+    assert (zeros == 0).all()
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="POSIX file handlers only")
+def test_handler_dir_cache_expiry(tmp_path, monkeypatch):
+    candidate = str(tmp_path)
+    monkeypatch.setattr(_FileHandler, "_dir_candidates", [candidate])
+    monkeypatch.setattr(_FileHandler, "_cached_dir", None)
+    monkeypatch.setattr(_FileHandler, "_cached_dir_free", 0)
+    monkeypatch.setattr(_FileHandler, "_cached_dir_time", 0.0)
+    probes = []
+    real_statvfs = os.statvfs
+
+    def statvfs(dirname):
+        probes.append(dirname)
+        return real_statvfs(dirname)
+
+    monkeypatch.setattr(os, "statvfs", statvfs)
+    _FileHandler(64)
+    _FileHandler(64)
+    # a burst of small allocations is served by a single probe
+    assert probes == [candidate]
+    # large allocations always probe
+    _FileHandler(2 * 1024 * 1024)
+    assert probes == [candidate] * 2
+    # so do allocations once the probe is too old
+    _FileHandler._cached_dir_time -= 3600
+    _FileHandler(64)
+    assert probes == [candidate] * 3
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="POSIX file handlers only")
+def test_handler_dir_fallback(tmp_path, monkeypatch):
+    candidate = str(tmp_path)
+    monkeypatch.setattr(_FileHandler, "_dir_candidates", [candidate])
+    monkeypatch.setattr(_FileHandler, "_cached_dir", None)
+    monkeypatch.setattr(_FileHandler, "_cached_dir_free", 0)
+    monkeypatch.setattr(_FileHandler, "_cached_dir_time", 0.0)
+    _FileHandler(64)
+    # the free space probe is cached for the next allocations
+    assert _FileHandler._cached_dir == candidate
+
+    open_unnamed = _FileHandler._open_unnamed
+    dirnames = []
+
+    def _open_unnamed(self, dirname):
+        dirnames.append(dirname)
+        if dirname == candidate:
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        return open_unnamed(self, dirname)
+
+    monkeypatch.setattr(_FileHandler, "_open_unnamed", _open_unnamed)
+    handler = _FileHandler(64)
+    assert dirnames == [candidate, util.get_temp_dir()]
+    assert _FileHandler._cached_dir is None
+    assert os.fstat(handler.fd).st_size == 64
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="POSIX file handlers only")
+def test_handler_dir_candidates(tmp_path, monkeypatch):
+    # candidates are read from TENSORDICT_SHM_DIR at import time only
+    first, second = str(tmp_path / "first"), str(tmp_path / "second")
+    os.mkdir(first)
+    os.mkdir(second)
+    monkeypatch.setattr(_FileHandler, "_dir_candidates", [first, second])
+    monkeypatch.setattr(_FileHandler, "_cached_dir", None)
+    monkeypatch.setattr(_FileHandler, "_cached_dir_free", 0)
+    monkeypatch.setattr(_FileHandler, "_cached_dir_time", 0.0)
+
+    open_unnamed = _FileHandler._open_unnamed
+    dirnames = []
+    failing = set()
+
+    def _open_unnamed(self, dirname):
+        dirnames.append(dirname)
+        if dirname in failing:
+            raise OSError(errno.EROFS, os.strerror(errno.EROFS))
+        return open_unnamed(self, dirname)
+
+    monkeypatch.setattr(_FileHandler, "_open_unnamed", _open_unnamed)
+    _FileHandler(64)
+    assert dirnames == [first]
+
+    # the next candidate is used when the file cannot be created in the first
+    failing.add(first)
+    dirnames.clear()
+    _FileHandler(64)
+    assert dirnames == [first, second]
+    assert _FileHandler._cached_dir is None
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="POSIX file handlers only")
+def test_memmap_empty_handler():
+    mt = MemoryMappedTensor.empty((0, 3))
+    assert mt.shape == (0, 3)
+    assert mt._handler.size == 0
+    assert (MemoryMappedTensor.zeros_like(mt) == 0).all()
+
+
+def test_handler_not_picklable():
+    mt = MemoryMappedTensor.from_tensor(torch.zeros(3))
+    # handlers can only be sent to other processes
+    with pytest.raises(RuntimeError):
+        pickle.dumps(mt._handler)
+    with pytest.raises(RuntimeError):
+        copy.deepcopy(mt._handler)
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="Linux only")
+def test_handler_hugepages(tmp_path, monkeypatch):
+    import tensordict.memmap
+
+    if "TENSORDICT_HUGEPAGE_DIR" not in os.environ:
+        # huge pages are opt-in
+        assert _FileHandler._hugepage_dir is None
+    # a hugetlbfs mount without size limit reports no blocks
+    statvfs = os.statvfs_result((4096, 4096, 0, 0, 0, 0, 0, 0, 0, 255))
+    monkeypatch.setattr(_FileHandler, "_hugepage_dir", str(tmp_path))
+    monkeypatch.setattr(_FileHandler, "_shm_dir", None)
+    monkeypatch.setattr(tensordict.memmap, "_HUGEPAGE_MIN_SIZE", 1)
+    real_statvfs = os.statvfs
+    monkeypatch.setattr(
+        os,
+        "statvfs",
+        lambda dirname: statvfs if dirname == str(tmp_path) else real_statvfs(dirname),
+    )
+    # the handler file is rounded up to whole pages
+    mt = MemoryMappedTensor.from_tensor(torch.arange(10))
+    assert mt._handler.size == 4096
+    assert os.fstat(mt._handler.fd).st_size == 4096
+    assert (mt == torch.arange(10)).all()
+    func, args = mt.__reduce__()
+    rebuilt = func(*args)
+    assert rebuilt.shape == mt.shape
+    rebuilt.zero_()
+    assert (mt == 0).all()
+
+    # a directory set by the user is tried before huge pages
+    shm_dir = tmp_path / "shm"
+    shm_dir.mkdir()
+    monkeypatch.setattr(_FileHandler, "_shm_dir", str(shm_dir))
+    mt = MemoryMappedTensor.from_tensor(torch.arange(10))
+    assert mt._handler.size == 80
+
+
 @pytest.fixture
 def dummy_memmap():
     return MemoryMappedTensor.from_tensor(torch.randn(10, 11))